@@ -3,23 +3,109 @@ Universal Media Downloader - Flask Application
 Web interface for downloading media from multiple platforms
 """
 
+import os
+
+# Cooperative I/O for the dev server (gunicorn's gevent worker patches by itself)
+if os.environ.get('GEVENT') == '1':
+    from gevent import monkey
+    monkey.patch_all()
+
 from flask import Flask, render_template, request, jsonify, send_from_directory, Response
 from downloader import MediaEngine
+import re
+import socket
 import threading
 import uuid
-import json
-import time
+import orjson
+from dataclasses import dataclass, field
 from pathlib import Path
+from cachetools import TTLCache
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'universal-media-downloader-secret-key'
+# Hand /downloads files to a fronting server with mod_xsendfile instead of Python
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
 # Initialize MediaEngine
 media_engine = MediaEngine(download_path='static/downloads')
 
-# Store download progress for each task
-download_progress = {}
-download_lock = threading.Lock()
+
+@dataclass
+class TaskState:
+    """Progress state of a single download task, guarded by its own lock"""
+    state: dict
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    event: threading.Event = field(default_factory=threading.Event)
+    
+    def update(self, **changes):
+        """Update progress fields and wake up SSE listeners"""
+        with self.lock:
+            self.state.update(changes)
+            self.event.set()
+    
+    def snapshot(self):
+        """Return a copy of the state and consume the pending wake-up"""
+        with self.lock:
+            self.event.clear()
+            return self.state.copy()
+
+
+class ThreadSafeTTLCache:
+    """Thread-safe wrapper around cachetools.TTLCache (which mutates on lookup)"""
+    
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+    
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+    
+    def get(self, key, default=None):
+        with self._lock:
+            return self._cache.get(key, default)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._cache.pop(key, default)
+    
+    def touch(self, key, value):
+        """Restart the TTL of key if it still maps to value"""
+        with self._lock:
+            if self._cache.get(key) is value:
+                self._cache[key] = value
+
+
+# Store download progress for each task (task_id -> TaskState)
+# Tasks expire an hour after their last update; each task has its own lock
+download_progress = ThreadSafeTTLCache(maxsize=10_000, ttl=3600)
+
+# Seconds between SSE keepalive comments when there are no updates
+SSE_KEEPALIVE = 15
+
+# Kernel send buffer for client sockets (lets the kernel ride out yt-dlp stalls)
+SEND_BUFFER_SIZE = 1 << 20
+
+# Characters not allowed in download filenames (\w is unicode alphanumerics + "_")
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w \-]')
+
+
+@app.before_request
+def tune_client_socket():
+    """
+    Disable Nagle's algorithm and enlarge the send buffer for streaming
+    
+    Only the Werkzeug dev server exposes the client socket; gunicorn's
+    sockets are tuned on the listener in gunicorn.conf.py
+    """
+    sock = request.environ.get('werkzeug.socket')
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    except OSError as e:
+        print(f"Error tuning client socket: {e}")
 
 
 @app.route('/')
@@ -28,36 +114,163 @@ def index():
     return render_template('index.html')
 
 
+def _sse(data, event=None):
+    """
+    Encode a Server-Sent Event
+    
+    Args:
+        data: JSON-serializable payload
+        event (str): Event name (None for the default "message" event)
+        
+    Returns:
+        bytes: Encoded event
+    """
+    payload = b"data: " + orjson.dumps(data) + b"\n\n"
+    if event:
+        return b"event: " + event.encode() + b"\n" + payload
+    return payload
+
+
+def _validate_url(url):
+    """
+    Check a user-supplied media URL
+    
+    Args:
+        url (str): URL from the request
+        
+    Returns:
+        str: Error message, or None if the URL is valid
+    """
+    if not url:
+        return 'Por favor ingresa una URL válida'
+    
+    if not url.startswith(('http://', 'https://')):
+        return 'La URL debe comenzar con http:// o https://'
+    
+    return None
+
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
     """
-    Analyze URL and return available formats
+    Analyze URL and return media info (title, thumbnail, uploader...)
+    
+    Formats are resolved separately by /api/formats, which is slower
     
     Expected JSON: {"url": "https://..."}
-    Returns: {"success": bool, "info": {...}, "formats": [...]} or {"success": false, "error": "..."}
+    Returns: {"success": bool, "info": {...}} or {"success": false, "error": "..."}
     """
     try:
         data = request.get_json()
         url = data.get('url', '').strip()
         
-        if not url:
+        # Validate URL format
+        error = _validate_url(url)
+        if error:
             return jsonify({
                 'success': False,
-                'error': 'Por favor ingresa una URL válida'
+                'error': error
             }), 400
         
+        # Analyze URL
+        result = media_engine.analyze_url(url)
+        
+        if result['success']:
+            return jsonify({
+                'success': True,
+                'info': result['info']
+            }), 200
+        else:
+            return jsonify(result), 400
+            
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Error del servidor: {str(e)}'
+        }), 500
+
+
+@app.route('/api/analyze/stream')
+def analyze_stream():
+    """
+    Analyze URL progressively (Server-Sent Events)
+    
+    Runs the extractor once: sends the media info as soon as it returns, then
+    one event per format once the same info has been processed
+    
+    Query: ?url=https://...
+    Returns:
+        Server-Sent Events stream: "meta" ({...info}), "format" ({...}) per
+        format, then "done" ({}) or "failure" ({"error": "..."})
+    """
+    url = request.args.get('url', '').strip()
+    
+    def generate():
+        """Generate SSE events"""
+        try:
+            # Validate URL format
+            error = _validate_url(url)
+            if error:
+                yield _sse({'error': error}, 'failure')
+                return
+            
+            # Fast pass: title, thumbnail, uploader...
+            result = media_engine.analyze_url(url)
+            if not result['success']:
+                yield _sse({'error': result['error']}, 'failure')
+                return
+            yield _sse(result['info'], 'meta')
+            
+            # Deep pass: available formats. It processes the info from the
+            # fast pass, which may already have needed it for the metadata
+            if 'formats' not in result:
+                result = media_engine.analyze_url(url, deep=True)
+                if not result['success']:
+                    yield _sse({'error': result['error']}, 'failure')
+                    return
+            for format_option in result['formats']:
+                yield _sse(format_option, 'format')
+            
+            yield _sse({}, 'done')
+            
+        except Exception as e:
+            yield _sse({'error': f'Error del servidor: {str(e)}'}, 'failure')
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tell nginx not to buffer events
+    response.headers['X-Accel-Buffering'] = 'no'
+    
+    return response
+
+
+@app.route('/api/formats', methods=['POST'])
+def get_formats():
+    """
+    Resolve the available download formats for a URL
+    
+    Expected JSON: {"url": "https://..."}
+    Returns: {"success": bool, "formats": [...]} or {"success": false, "error": "..."}
+    """
+    try:
+        data = request.get_json()
+        url = data.get('url', '').strip()
+        
         # Validate URL format
-        if not url.startswith(('http://', 'https://')):
+        error = _validate_url(url)
+        if error:
             return jsonify({
                 'success': False,
-                'error': 'La URL debe comenzar con http:// o https://'
+                'error': error
             }), 400
         
-        # Analyze URL
-        result = media_engine.analyze_url(url)
+        result = media_engine.analyze_url(url, deep=True)
         
         if result['success']:
-            return jsonify(result), 200
+            return jsonify({
+                'success': True,
+                'formats': result['formats']
+            }), 200
         else:
             return jsonify(result), 400
             
@@ -92,7 +305,7 @@ def download():
                 'error': 'URL no proporcionada'
             }), 400
         
-        # Get video info first to determine filename
+        # Get video info first to determine filename (cached after /api/analyze)
         info_result = media_engine.analyze_url(url)
         if not info_result['success']:
             return jsonify({
@@ -103,7 +316,7 @@ def download():
         # Generate filename
         title = info_result['info']['title']
         # Sanitize filename
-        safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).strip()
+        safe_title = UNSAFE_FILENAME_CHARS.sub('', title).strip()
         safe_title = safe_title[:100]  # Limit length
         
         if format_choice.startswith('audio_'):
@@ -127,6 +340,8 @@ def download():
         response = Response(generate(), mimetype=mimetype)
         response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
         response.headers['Cache-Control'] = 'no-cache'
+        # Tell nginx not to buffer the stream
+        response.headers['X-Accel-Buffering'] = 'no'
         
         return response
         
@@ -146,28 +361,31 @@ def download_worker(task_id, url, format_choice):
         url (str): Media URL
         format_choice (str): Selected format
     """
+    def update_task(**changes):
+        """Update the task and restart its expiry (it is still active)"""
+        task.update(**changes)
+        download_progress.touch(task_id, task)
+    
     def progress_callback(progress_info):
         """Update progress information"""
-        with download_lock:
-            if progress_info['status'] == 'downloading':
-                download_progress[task_id] = {
-                    'status': 'downloading',
-                    'percentage': round(progress_info['percentage'], 1),
-                    'message': f"Descargando... {round(progress_info['percentage'], 1)}%"
-                }
-            elif progress_info['status'] == 'finished':
-                download_progress[task_id]['status'] = 'processing'
-                download_progress[task_id]['message'] = 'Procesando archivo...'
+        if progress_info['status'] == 'downloading':
+            update_task(
+                status='downloading',
+                percentage=round(progress_info['percentage'], 1),
+                message=f"Descargando... {round(progress_info['percentage'], 1)}%"
+            )
+        elif progress_info['status'] == 'finished':
+            update_task(status='processing', message='Procesando archivo...')
+    
+    # Register task
+    task = TaskState({
+        'status': 'downloading',
+        'percentage': 0,
+        'message': 'Conectando...'
+    })
+    download_progress[task_id] = task
     
     try:
-        # Update status
-        with download_lock:
-            download_progress[task_id] = {
-                'status': 'downloading',
-                'percentage': 0,
-                'message': 'Conectando...'
-            }
-        
         # Download media
         result = media_engine.download_media(
             url=url,
@@ -176,29 +394,26 @@ def download_worker(task_id, url, format_choice):
         )
         
         if result['success']:
-            with download_lock:
-                download_progress[task_id] = {
-                    'status': 'completed',
-                    'percentage': 100,
-                    'message': 'Descarga completada',
-                    'filename': result['filename'],
-                    'download_url': f"/downloads/{result['filename']}"
-                }
+            update_task(
+                status='completed',
+                percentage=100,
+                message='Descarga completada',
+                filename=result['filename'],
+                download_url=f"/downloads/{result['filename']}"
+            )
         else:
-            with download_lock:
-                download_progress[task_id] = {
-                    'status': 'error',
-                    'percentage': 0,
-                    'message': result.get('error', 'Error desconocido')
-                }
+            update_task(
+                status='error',
+                percentage=0,
+                message=result.get('error', 'Error desconocido')
+            )
     
     except Exception as e:
-        with download_lock:
-            download_progress[task_id] = {
-                'status': 'error',
-                'percentage': 0,
-                'message': f'Error: {str(e)}'
-            }
+        update_task(
+            status='error',
+            percentage=0,
+            message=f'Error: {str(e)}'
+        )
 
 
 @app.route('/api/progress/<task_id>')
@@ -214,31 +429,43 @@ def get_progress(task_id):
     """
     def generate():
         """Generate SSE events"""
+        task = download_progress.get(task_id)
+        
+        if task is None:
+            not_found = {
+                'status': 'not_found',
+                'percentage': 0,
+                'message': 'Tarea no encontrada'
+            }
+            yield _sse(not_found)
+            return
+        
         last_status = None
         
         while True:
-            with download_lock:
-                if task_id in download_progress:
-                    current_progress = download_progress[task_id].copy()
-                else:
-                    current_progress = {
-                        'status': 'not_found',
-                        'percentage': 0,
-                        'message': 'Tarea no encontrada'
-                    }
+            current_progress = task.snapshot()
             
             # Send update if status changed
             if current_progress != last_status:
-                yield f"data: {json.dumps(current_progress)}\n\n"
-                last_status = current_progress.copy()
+                yield _sse(current_progress)
+                last_status = current_progress
             
             # Stop streaming if completed or error
-            if current_progress['status'] in ['completed', 'error', 'not_found']:
+            if current_progress['status'] in ['completed', 'error']:
                 break
             
-            time.sleep(0.5)  # Update every 500ms
+            # Block until the worker reports new data
+            if not task.event.wait(timeout=SSE_KEEPALIVE):
+                if download_progress.get(task_id) is not task:
+                    break  # Task was cleaned up
+                yield b": keepalive\n\n"
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tell nginx not to buffer events
+    response.headers['X-Accel-Buffering'] = 'no'
     
-    return Response(generate(), mimetype='text/event-stream')
+    return response
 
 
 @app.route('/downloads/<filename>')
@@ -246,6 +473,9 @@ def download_file(filename):
     """
     Serve downloaded files
     
+    send_from_directory returns the file through wsgi.file_wrapper, which
+    gunicorn serves with sendfile(2), so no bytes are copied in Python.
+    
     Args:
         filename (str): Name of the file to download
         
@@ -277,9 +507,7 @@ def cleanup_task(task_id):
     Returns:
         Success response
     """
-    with download_lock:
-        if task_id in download_progress:
-            del download_progress[task_id]
+    download_progress.pop(task_id, None)
     
     return jsonify({
         'success': True,
@@ -301,4 +529,4 @@ if __name__ == '__main__':
     print("⚠️  Presiona Ctrl+C para detener el servidor")
     print("=" * 60)
     
-    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
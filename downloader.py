@@ -4,10 +4,267 @@ Handles media downloading from multiple platforms using yt-dlp
 """
 
 import yt_dlp
+import json
 import random
 import os
+import queue
+import signal
 import subprocess
+import sys
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from types import MappingProxyType
+from cachetools import TTLCache
+
+
+# yt-dlp extractors are pure Python and hold the GIL for the whole extraction,
+# so metadata extraction runs in a pool of worker processes (created lazily).
+# Each worker costs ~50 MB and containers often report the host's CPU count,
+# so the pool size is capped (override with EXTRACT_WORKERS)
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', min(os.cpu_count() or 1, 4)))
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+# Jobs wait here for a free worker, so their timeout only covers running time
+_extract_slots = threading.BoundedSemaphore(EXTRACT_WORKERS)
+
+
+def _get_extract_pool():
+    """Return the shared extraction process pool, creating it on first use"""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            # spawn: forking a multi-threaded web worker isn't safe
+            _extract_pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _extract_pool
+
+
+def _discard_extract_pool(pool, kill=False):
+    """
+    Drop a pool so the next _get_extract_pool() builds a new one
+    
+    Args:
+        pool (ProcessPoolExecutor): Broken or stuck pool
+        kill (bool): Kill its workers (their running jobs fail and are retried)
+    """
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is pool:
+            _extract_pool = None
+    if kill:
+        # The executor can't stop a single worker, so all of them go
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+    pool.shutdown(wait=False)
+
+
+class _ExtractTimeout(BaseException):
+    """Raised in a pool worker when its job runs out of time"""
+
+
+def _on_extract_alarm(signum, frame):
+    raise _ExtractTimeout()
+
+
+def _run_with_timeout(timeout, fn, *args):
+    """
+    Run a job in a pool worker, interrupting it after timeout seconds
+    
+    Jobs run in the worker's main thread, so SIGALRM can interrupt them
+    and the worker stays usable
+    
+    Args:
+        timeout (float): Seconds the job may run
+        fn (callable): Top-level function to run
+        *args: Its arguments
+        
+    Returns:
+        The function's result
+        
+    Raises:
+        concurrent.futures.TimeoutError: The job ran out of time
+    """
+    # BaseException, so yt-dlp's "except Exception" handlers don't swallow it
+    signal.signal(signal.SIGALRM, _on_extract_alarm)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return fn(*args)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _ExtractTimeout:
+        raise FuturesTimeoutError() from None
+
+
+# Building a YoutubeDL (and its extractors on first use) is expensive, so pool
+# workers keep one instance per thread (yt-dlp instances are not thread-safe)
+_ydl_local = threading.local()
+
+
+def _get_ydl(ydl_opts):
+    """
+    Return the thread's reusable YoutubeDL, replacing it if the options changed
+    
+    Args:
+        ydl_opts (dict): yt-dlp options (JSON-serializable)
+        
+    Returns:
+        yt_dlp.YoutubeDL: Cached instance
+    """
+    key = json.dumps(ydl_opts, sort_keys=True)
+    cached = getattr(_ydl_local, 'cached', None)
+    if cached is not None:
+        cached_key, ydl = cached
+        if cached_key == key:
+            return ydl
+        # Saves cookies (reloaded first, so nothing stale is written back)
+        # and closes the request handlers
+        _reload_cookies(ydl)
+        ydl.close()
+    
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    _ydl_local.cached = (key, ydl)
+    return ydl
+
+
+def _reload_cookies(ydl):
+    """
+    Replace the instance's cookie jar with the current contents of cookiefile
+    
+    Every pool worker shares the cookie file and writes it back after each
+    call, so the jar loaded when the instance was built goes stale
+    
+    Args:
+        ydl (yt_dlp.YoutubeDL): Reused instance
+    """
+    if ydl.params.get('cookiefile'):
+        ydl.cookiejar.clear()
+        ydl.cookiejar.load()
+
+
+def _run_ydl(ydl_opts, action):
+    """
+    Run a yt-dlp call in a pool worker
+    
+    Args:
+        ydl_opts (dict): yt-dlp options
+        action (callable): Called with the YoutubeDL, returns a picklable result
+        
+    Returns:
+        The action's result
+    """
+    # yt-dlp exceptions can hold unpicklable state, so only their message
+    # is sent back to the parent process
+    ydl = _get_ydl(ydl_opts)
+    try:
+        _reload_cookies(ydl)
+        return action(ydl)
+    except yt_dlp.utils.DownloadError as e:
+        raise yt_dlp.utils.DownloadError(str(e)) from None
+    except Exception as e:
+        raise RuntimeError(str(e)) from None
+    finally:
+        # The instance stays open, so write rotated session cookies back now
+        ydl.save_cookies()
+
+
+def _extract_info(url, ydl_opts):
+    """
+    Run the extractor for a URL in a pool worker
+    
+    Single videos are returned unprocessed (formats not resolved). Playlists
+    and URL redirects are processed right away: their entries can be lazy
+    generators, which don't survive sanitize_info
+    
+    Args:
+        url (str): Media URL to analyze
+        ydl_opts (dict): yt-dlp options
+        
+    Returns:
+        tuple: (sanitized info dict or None, whether it was processed)
+    """
+    def extract(ydl):
+        info = ydl.extract_info(url, download=False, process=False)
+        if info is None or info.get('_type', 'video') == 'video':
+            return ydl.sanitize_info(info), False
+        # Same as extract_info(process=True), without running the extractor again
+        return ydl.sanitize_info(ydl.process_ie_result(info, download=False)), True
+    
+    return _run_ydl(ydl_opts, extract)
+
+
+def _process_info(info, ydl_opts):
+    """
+    Resolve formats of an unprocessed video from _extract_info in a pool worker
+    
+    Same as yt-dlp's --load-info-json: the extractor doesn't run again
+    
+    Args:
+        info (dict): Sanitized unprocessed info dict of a single video
+        ydl_opts (dict): yt-dlp options
+        
+    Returns:
+        dict: Sanitized processed info dict, or None
+    """
+    return _run_ydl(ydl_opts, lambda ydl: ydl.sanitize_info(ydl.process_ie_result(info, download=False)))
+
+
+def _pump_pipe(stream, chunks, chunk_size, stop):
+    """
+    Copy a pipe into a bounded queue until EOF, then put None
+    
+    Args:
+        stream: Unbuffered pipe to read from
+        chunks (queue.Queue): Bounded queue consumed by the response generator
+        chunk_size (int): Max bytes per read
+        stop (threading.Event): Set when the consumer has gone away
+    """
+    def put(item):
+        # Block while the queue is full, but give up once the consumer stops
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk or not put(chunk):
+                break
+    except (OSError, ValueError) as e:
+        print(f"Error reading download pipe: {e}")
+    finally:
+        put(None)
+
+
+def _kill_process(process):
+    """Kill a process started with start_new_session=True and its children"""
+    if hasattr(os, 'killpg'):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+            return
+        except ProcessLookupError:
+            pass
+    process.kill()
+
+
+def _video_format_selector(height):
+    """Select best video at this height + best audio, with fallbacks"""
+    return (
+        f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/'
+        f'bestvideo[height<={height}]+bestaudio/'
+        f'best[height<={height}]/'
+        'best'
+    )
 
 
 class MediaEngine:
@@ -17,13 +274,76 @@ class MediaEngine:
     """
     
     # User-Agent rotation to avoid blocking
-    USER_AGENTS = [
+    USER_AGENTS = (
         'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
         'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
-    ]
+    )
+    
+    # Base options for yt-dlp (nested values are shared, never mutate them)
+    BASE_OPTIONS = MappingProxyType({
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'format': 'best',
+        # Anti-blocking options
+        'nocheckcertificate': True,
+        'ignoreerrors': False,
+        'logtostderr': False,
+        'default_search': 'auto',
+        'source_address': '0.0.0.0', # Force IPv4
+        # Use Android client to avoid "Sign in to confirm you're not a bot"
+        'extractor_args': {
+            'youtube': {
+                'player_client': ['android', 'ios'],
+            }
+        },
+        # Add headers
+        'http_headers': {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-us,en;q=0.5',
+            'Sec-Fetch-Mode': 'navigate',
+        }
+    })
+    
+    # Quality indicators for video labels (min height, tier), highest first
+    QUALITY_TIERS = (
+        (2160, '4K'),
+        (1440, '2K'),
+        (1080, 'Full HD'),
+        (720, 'HD'),
+        (0, ''),
+    )
+    
+    # Format selectors
+    AUDIO_FORMAT = 'bestaudio/best'
+    BEST_VIDEO_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+    VIDEO_FORMAT_SELECTORS = {
+        height: _video_format_selector(height)
+        for height in (144, 240, 360, 480, 720, 1080, 1440, 2160)
+    }
+    
+    # Successful analysis results are reused so /api/download doesn't re-extract
+    ANALYZE_CACHE_SIZE = 256
+    ANALYZE_CACHE_TTL = 300  # seconds
+    
+    # Seconds a metadata extraction may run in the process pool
+    EXTRACT_TIMEOUT = 60
+    
+    # Extra seconds before a worker that ignored the timeout is killed
+    EXTRACT_KILL_GRACE = 10
+    
+    # Min seconds between forwarded download progress updates
+    PROGRESS_INTERVAL = 0.2
+    
+    # Max bytes per pipe read when streaming (fewer Python/WSGI round-trips)
+    STREAM_CHUNK_SIZE = 262144
+    
+    # Chunks read ahead of the client (caps buffered data at 1 MiB)
+    STREAM_BUFFER_CHUNKS = 4
     
     def __init__(self, download_path='static/downloads'):
         """
@@ -35,6 +355,17 @@ class MediaEngine:
         self.download_path = Path(download_path)
         self.download_path.mkdir(parents=True, exist_ok=True)
         
+        # Add cookies if available (written once, not on every call)
+        base_options = dict(self.BASE_OPTIONS)
+        cookie_path = self._get_cookies_path()
+        if cookie_path:
+            base_options['cookiefile'] = cookie_path
+        self._base_options = MappingProxyType(base_options)
+        
+        self._analyze_cache = TTLCache(maxsize=self.ANALYZE_CACHE_SIZE, ttl=self.ANALYZE_CACHE_TTL)
+        self._raw_info_cache = TTLCache(maxsize=self.ANALYZE_CACHE_SIZE, ttl=self.ANALYZE_CACHE_TTL)
+        self._analyze_cache_lock = threading.Lock()
+        
     def _get_random_user_agent(self):
         """Return a random User-Agent to avoid blocking"""
         return random.choice(self.USER_AGENTS)
@@ -61,83 +392,138 @@ class MediaEngine:
             return None
 
     def _get_base_options(self):
-        """Base options for yt-dlp"""
-        opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'format': 'best',
-            # Anti-blocking options
-            'nocheckcertificate': True,
-            'ignoreerrors': False,
-            'logtostderr': False,
-            'quiet': True,
-            'no_warnings': True,
-            'default_search': 'auto',
-            'source_address': '0.0.0.0', # Force IPv4
-            # Use Android client to avoid "Sign in to confirm you're not a bot"
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'ios'],
-                }
-            },
-            # Add headers
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Sec-Fetch-Mode': 'navigate',
-            }
-        }
+        """
+        Base options for yt-dlp
         
-        # Add cookies if available
-        cookie_path = self._get_cookies_path()
-        if cookie_path:
-            opts['cookiefile'] = cookie_path
-            
-        return opts
+        Returns a read-only view built once per engine; callers that need to
+        change options copy it with {**base, ...}
+        """
+        return self._base_options
     
-    def analyze_url(self, url):
+    def analyze_url(self, url, deep=False):
         """
         Analyze URL and extract metadata without downloading
         
+        The default (shallow) analysis only runs the extractor and returns the
+        media info; deep=True also processes the formats and lists them,
+        reusing the extractor output of an earlier shallow analysis.
+        Successful results are cached per URL for ANALYZE_CACHE_TTL seconds
+        
+        Args:
+            url (str): Media URL to analyze
+            deep (bool): Also resolve the available formats
+            
+        Returns:
+            dict: Contains 'success', 'info', 'formats' (deep only), or 'error'
+        """
+        with self._analyze_cache_lock:
+            # A cached deep result also answers a shallow request
+            result = self._analyze_cache.get((url, True))
+            if result is None and not deep:
+                result = self._analyze_cache.get((url, False))
+        if result is not None:
+            return result
+        
+        result = self._extract_metadata(url, deep)
+        if result['success']:
+            with self._analyze_cache_lock:
+                self._analyze_cache[(url, 'formats' in result)] = result
+        return result
+    
+    def _run_in_extract_pool(self, fn, *args):
+        """
+        Run a function in the extraction pool and wait for its result
+        
+        Waiting for a free worker doesn't count against EXTRACT_TIMEOUT. If a
+        pool worker died (OOM kill, crash) the pool is unusable, so it is
+        replaced and the call retried once
+        
+        Args:
+            fn (callable): Top-level function to run
+            *args: Picklable arguments
+            
+        Returns:
+            The function's result
+            
+        Raises:
+            concurrent.futures.TimeoutError: The job ran for EXTRACT_TIMEOUT
+        """
+        for attempt in range(2):
+            with _extract_slots:
+                pool = _get_extract_pool()
+                try:
+                    future = pool.submit(_run_with_timeout, self.EXTRACT_TIMEOUT, fn, *args)
+                    try:
+                        return future.result(timeout=self.EXTRACT_TIMEOUT + self.EXTRACT_KILL_GRACE)
+                    except FuturesTimeoutError:
+                        if not future.done():
+                            # The worker didn't stop at the timeout (stuck outside
+                            # Python code), so replace it
+                            _discard_extract_pool(pool, kill=True)
+                        raise
+                except BrokenProcessPool:
+                    _discard_extract_pool(pool)
+                    if attempt:
+                        raise
+    
+    def _extract_metadata(self, url, deep):
+        """
+        Run yt-dlp extraction for a URL (uncached)
+        
         Args:
             url (str): Media URL to analyze
+            deep (bool): Process formats (otherwise only the extractor runs)
             
         Returns:
-            dict: Contains 'success', 'info', 'formats', or 'error'
+            dict: Contains 'success', 'info', 'formats' (deep only), or 'error'
         """
         try:
-            ydl_opts = self._get_base_options()
-            ydl_opts.update({
+            ydl_opts = {
+                **self._get_base_options(),
                 'skip_download': True,
-                'no_warnings': True,
-            })
+            }
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                if info is None:
-                    return {
-                        'success': False,
-                        'error': 'No se pudo obtener información del enlace'
-                    }
-                
-                # Get available formats
-                formats = self.get_available_formats(info)
-                
+            # Run the extractor once per URL; an unprocessed video is kept so
+            # that a later deep analysis only has to process it
+            with self._analyze_cache_lock:
+                info = self._raw_info_cache.get(url)
+            processed = False
+            if info is None:
+                # Extraction holds the GIL, so it runs in a worker process
+                info, processed = self._run_in_extract_pool(_extract_info, url, ydl_opts)
+            
+            if info is not None and not processed:
+                if deep or not info.get('title'):
+                    info = self._run_in_extract_pool(_process_info, info, ydl_opts)
+                    processed = True
+                    with self._analyze_cache_lock:
+                        # The deep result gets cached, the raw one isn't needed
+                        self._raw_info_cache.pop(url, None)
+                else:
+                    with self._analyze_cache_lock:
+                        self._raw_info_cache[url] = info
+            
+            if info is None:
                 return {
-                    'success': True,
-                    'info': {
-                        'title': info.get('title', 'Sin título'),
-                        'duration': info.get('duration', 0),
-                        'thumbnail': info.get('thumbnail', ''),
-                        'uploader': info.get('uploader', 'Desconocido'),
-                        'platform': info.get('extractor_key', 'Unknown'),
-                    },
-                    'formats': formats
+                    'success': False,
+                    'error': 'No se pudo obtener información del enlace'
                 }
-                
+            
+            result = {
+                'success': True,
+                'info': self._get_media_info(info),
+            }
+            if processed:
+                # Get available formats
+                result['formats'] = self.get_available_formats(info)
+            
+            return result
+            
+        except FuturesTimeoutError:
+            return {
+                'success': False,
+                'error': 'Tiempo de espera agotado al analizar'
+            }
         except yt_dlp.utils.DownloadError as e:
             error_msg = str(e)
             if 'Private video' in error_msg or 'not available' in error_msg:
@@ -161,6 +547,47 @@ class MediaEngine:
                 'error': f'Error inesperado: {str(e)}'
             }
     
+    def _get_media_info(self, info):
+        """
+        Extract the display metadata from video info
+        
+        Args:
+            info (dict): Video information from yt-dlp
+            
+        Returns:
+            dict: Title, duration, thumbnail, uploader and platform
+        """
+        thumbnail = info.get('thumbnail')
+        thumbnails = [t for t in info.get('thumbnails') or [] if t.get('url')]
+        if not thumbnail and thumbnails:
+            # Unprocessed results only have the unsorted list (yt-dlp sorts it
+            # by preference while processing), so pick the best one here
+            best = max(thumbnails, key=lambda t: (t.get('preference') or 0, t.get('width') or 0))
+            thumbnail = best['url']
+        
+        return {
+            'title': info.get('title', 'Sin título'),
+            'duration': info.get('duration', 0),
+            'thumbnail': thumbnail or '',
+            'uploader': info.get('uploader', 'Desconocido'),
+            'platform': info.get('extractor_key', 'Unknown'),
+        }
+    
+    def _get_quality_label(self, height):
+        """
+        Create a video label with quality indicator (e.g. "Video 1080p (Full HD) MP4")
+        
+        Args:
+            height (int): Video height in pixels
+            
+        Returns:
+            str: Format label
+        """
+        tier = next(name for min_height, name in self.QUALITY_TIERS if height >= min_height)
+        if tier:
+            return f'Video {height}p ({tier}) MP4'
+        return f'Video {height}p MP4'
+    
     def get_available_formats(self, info):
         """
         Extract and organize available formats from video info
@@ -183,8 +610,9 @@ class MediaEngine:
         
         # Get video formats
         if 'formats' in info and info['formats']:
-            # Collect all video formats (including those that need audio merging)
-            video_formats = []
+            # Keep the best format per height in a single pass
+            # (prefer formats that include audio, then larger files)
+            best_by_height = {}
             
             for f in info['formats']:
                 # Skip audio-only formats
@@ -193,44 +621,30 @@ class MediaEngine:
                 
                 # Get video height
                 height = f.get('height')
-                if height and height >= 144:  # Minimum quality threshold
-                    video_formats.append({
+                if not height or height < 144:  # Minimum quality threshold
+                    continue
+                
+                has_audio = f.get('acodec') != 'none'
+                filesize = f.get('filesize') or 0
+                current = best_by_height.get(height)
+                if current is None or (has_audio, filesize) > (current['has_audio'], current['filesize']):
+                    best_by_height[height] = {
                         'height': height,
                         'format_id': f['format_id'],
                         'ext': f.get('ext', 'mp4'),
-                        'filesize': f.get('filesize', 0),
-                        'has_audio': f.get('acodec') != 'none'
-                    })
-            
-            # Sort by quality (height) descending
-            video_formats.sort(key=lambda x: x['height'], reverse=True)
+                        'filesize': filesize,
+                        'has_audio': has_audio
+                    }
             
-            # Add quality options (deduplicate by height)
-            seen_heights = set()
-            for vf in video_formats:
-                height = vf['height']
-                if height not in seen_heights:
-                    seen_heights.add(height)
-                    
-                    # Create label with quality indicator
-                    if height >= 2160:
-                        quality_label = f'Video {height}p (4K) MP4'
-                    elif height >= 1440:
-                        quality_label = f'Video {height}p (2K) MP4'
-                    elif height >= 1080:
-                        quality_label = f'Video {height}p (Full HD) MP4'
-                    elif height >= 720:
-                        quality_label = f'Video {height}p (HD) MP4'
-                    else:
-                        quality_label = f'Video {height}p MP4'
-                    
-                    formats.append({
-                        'id': f"video_{height}p",
-                        'label': quality_label,
-                        'type': 'video',
-                        'ext': 'mp4',
-                        'height': height
-                    })
+            # Add quality options, highest first
+            for height in sorted(best_by_height, reverse=True):
+                formats.append({
+                    'id': f"video_{height}p",
+                    'label': self._get_quality_label(height),
+                    'type': 'video',
+                    'ext': 'mp4',
+                    'height': height
+                })
         
         # If no specific formats found, add best quality option
         if len(formats) == 1:  # Only audio option
@@ -243,6 +657,54 @@ class MediaEngine:
         
         return formats
     
+    def _get_format_selector(self, format_choice):
+        """
+        Map a format ID from get_available_formats to a yt-dlp format selector
+        
+        Args:
+            format_choice (str): Format ID (e.g. "audio_mp3", "video_1080p")
+            
+        Returns:
+            str: yt-dlp format selector
+        """
+        if format_choice.startswith('audio_'):
+            return self.AUDIO_FORMAT
+        if not format_choice.startswith('video_'):
+            return 'best'
+        if format_choice == 'video_best':
+            return self.BEST_VIDEO_FORMAT
+        
+        # Extract height from choice (e.g., "video_1080p" -> "1080")
+        height_str = format_choice.replace('video_', '').replace('p', '')
+        try:
+            height = int(height_str)
+        except ValueError:
+            # Fallback to best if parsing fails
+            return self.BEST_VIDEO_FORMAT
+        
+        return self.VIDEO_FORMAT_SELECTORS.get(height) or _video_format_selector(height)
+    
+    def _configure_format(self, ydl_opts, format_choice):
+        """
+        Set format selection and post-processing options for a format choice
+        
+        Args:
+            ydl_opts (dict): yt-dlp options to update in place
+            format_choice (str): Format ID from get_available_formats
+        """
+        ydl_opts['format'] = self._get_format_selector(format_choice)
+        
+        if format_choice.startswith('audio_'):
+            # Audio extraction
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }]
+        elif format_choice.startswith('video_'):
+            # Ensure MP4 output
+            ydl_opts['merge_output_format'] = 'mp4'
+    
     def download_media(self, url, format_choice='video_best', progress_callback=None):
         """
         Download media with specified format
@@ -256,51 +718,17 @@ class MediaEngine:
             dict: Contains 'success', 'filename', 'path', or 'error'
         """
         try:
-            ydl_opts = self._get_base_options()
-            
             # Configure output template
             output_template = str(self.download_path / '%(title)s.%(ext)s')
             
-            ydl_opts.update({
+            ydl_opts = {
+                **self._get_base_options(),
                 'outtmpl': output_template,
                 'progress_hooks': [self._create_progress_hook(progress_callback)] if progress_callback else [],
-            })
+            }
             
             # Configure format based on choice
-            if format_choice.startswith('audio_'):
-                # Audio extraction
-                ydl_opts.update({
-                    'format': 'bestaudio/best',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }],
-                })
-            elif format_choice.startswith('video_'):
-                # Video download
-                if format_choice == 'video_best':
-                    # Best quality available
-                    ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-                else:
-                    # Extract height from choice (e.g., "video_1080p" -> "1080")
-                    height_str = format_choice.replace('video_', '').replace('p', '')
-                    
-                    try:
-                        height = int(height_str)
-                        # Select best video at this height + best audio, with fallbacks
-                        ydl_opts['format'] = (
-                            f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/'
-                            f'bestvideo[height<={height}]+bestaudio/'
-                            f'best[height<={height}]/'
-                            'best'
-                        )
-                    except ValueError:
-                        # Fallback to best if parsing fails
-                        ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-                
-                # Ensure MP4 output
-                ydl_opts['merge_output_format'] = 'mp4'
+            self._configure_format(ydl_opts, format_choice)
             
             # Download
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
@@ -339,9 +767,33 @@ class MediaEngine:
                 'error': f'Error inesperado: {str(e)}'
             }
     
+    def _get_base_cli_args(self):
+        """Base command line for running yt-dlp as a subprocess (mirrors _get_base_options)"""
+        opts = self._get_base_options()
+        
+        args = [
+            sys.executable, '-m', 'yt_dlp',
+            '--quiet',
+            '--no-warnings',
+            '--no-check-certificates',
+            '--default-search', 'auto',
+            '--force-ipv4',
+            '--extractor-args', 'youtube:player_client=android,ios',
+        ]
+        for header, value in opts['http_headers'].items():
+            args += ['--add-header', f'{header}:{value}']
+        
+        if 'cookiefile' in opts:
+            args += ['--cookies', opts['cookiefile']]
+        
+        return args
+    
     def stream_download(self, url, format_choice='video_best'):
         """
-        Download to temp file, stream it, and delete it afterwards
+        Stream media from yt-dlp's stdout without writing it to disk
+        
+        Video is muxed by ffmpeg as fragmented MP4 so it can be written to a
+        pipe as it downloads. Audio is piped through ffmpeg to encode MP3.
         
         Args:
             url (str): Media URL to download
@@ -350,104 +802,128 @@ class MediaEngine:
         Yields:
             bytes: Chunks of file data
         """
-        import tempfile
-        import time
+        cmd = self._get_base_cli_args()
+        ffmpeg_cmd = None
+        
+        # Configure format based on choice
+        cmd += ['-f', self._get_format_selector(format_choice)]
         
-        temp_dir = tempfile.mkdtemp()
-        temp_path = Path(temp_dir)
+        if format_choice.startswith('audio_'):
+            # yt-dlp can't post-process stdout, so transcode in a second process
+            ffmpeg_cmd = [
+                'ffmpeg', '-loglevel', 'error',
+                '-i', 'pipe:0',
+                '-vn', '-codec:a', 'libmp3lame', '-b:a', '192k',
+                '-f', 'mp3', 'pipe:1',
+            ]
+        elif format_choice.startswith('video_'):
+            cmd += [
+                '--merge-output-format', 'mp4',
+                # Let ffmpeg fetch and remux every protocol (HTTP, HLS, DASH)
+                # into fragmented MP4: a regular MP4 needs a seekable output,
+                # fragments can be sent as soon as the first moof is muxed
+                '--downloader', 'ffmpeg',
+                '--downloader-args', 'ffmpeg_o:-movflags frag_keyframe+empty_moov+default_base_moof -f mp4',
+            ]
         
+        cmd += ['-o', '-', '--', url]
+        
+        processes = []
+        chunks = queue.Queue(maxsize=self.STREAM_BUFFER_CHUNKS)
+        stop = threading.Event()
+        pump = None
         try:
-            ydl_opts = self._get_base_options()
+            # Own process group so yt-dlp's ffmpeg child can be killed with it
+            ytdlp = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=0,
+                start_new_session=True
+            )
+            processes.append(ytdlp)
             
-            # Use temp path for output
-            output_template = str(temp_path / '%(title)s.%(ext)s')
+            if ffmpeg_cmd:
+                ffmpeg = subprocess.Popen(
+                    ffmpeg_cmd,
+                    stdin=ytdlp.stdout,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    bufsize=0,
+                    start_new_session=True
+                )
+                processes.append(ffmpeg)
+                # Only ffmpeg reads yt-dlp's output now
+                ytdlp.stdout.close()
             
-            ydl_opts.update({
-                'outtmpl': output_template,
-                'quiet': True,
-                'no_warnings': True,
-            })
+            # Read ahead into a bounded queue: the pipe keeps draining while the
+            # client write blocks, and a slow client stalls the pipe once full
+            pump = threading.Thread(
+                target=_pump_pipe,
+                args=(processes[-1].stdout, chunks, self.STREAM_CHUNK_SIZE, stop),
+                daemon=True
+            )
+            pump.start()
             
-            # Configure format based on choice
-            if format_choice.startswith('audio_'):
-                # Audio extraction
-                ydl_opts.update({
-                    'format': 'bestaudio/best',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }],
-                })
-            elif format_choice.startswith('video_'):
-                # Video download logic
-                if format_choice == 'video_best':
-                    ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-                else:
-                    height_str = format_choice.replace('video_', '').replace('p', '')
-                    try:
-                        height = int(height_str)
-                        ydl_opts['format'] = (
-                            f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/'
-                            f'bestvideo[height<={height}]+bestaudio/'
-                            f'best[height<={height}]/'
-                            'best'
-                        )
-                    except ValueError:
-                        ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-                
-                ydl_opts['merge_output_format'] = 'mp4'
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
             
-            # Download to temp file
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                if format_choice.startswith('audio_'):
-                    filename = ydl.prepare_filename(info).replace('.webm', '.mp3').replace('.m4a', '.mp3')
-                else:
-                    filename = ydl.prepare_filename(info)
-                
-                # Handle case where filename might be different due to merging
-                if not os.path.exists(filename):
-                     # Try to find the file in the temp dir
-                    files = list(temp_path.glob('*'))
-                    if files:
-                        filename = str(files[0])
+            for process in processes:
+                process.wait()
             
-            # Stream the file
-            if os.path.exists(filename):
-                with open(filename, 'rb') as f:
-                    while True:
-                        chunk = f.read(8192)
-                        if not chunk:
-                            break
-                        yield chunk
+            if ytdlp.returncode != 0:
+                error_msg = ytdlp.stderr.read().decode('utf-8', errors='replace').strip()
+                raise RuntimeError(f'yt-dlp failed ({ytdlp.returncode}): {error_msg}')
+            if ffmpeg_cmd and processes[-1].returncode != 0:
+                raise RuntimeError(f'ffmpeg failed ({processes[-1].returncode})')
             
         except Exception as e:
-            print(f"Temp download error: {e}")
+            print(f"Stream download error: {e}")
             raise
             
         finally:
-            # Cleanup temp directory and files
-            try:
-                import shutil
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                print(f"Error cleaning up temp dir: {e}")
+            # Stop the pipeline if the client disconnected mid-stream
+            stop.set()
+            for process in processes:
+                if process.poll() is None:
+                    _kill_process(process)
+                process.wait()
+            if pump:
+                pump.join()
+            for process in processes:
+                if process.stdout:
+                    process.stdout.close()
+                if process.stderr:
+                    process.stderr.close()
     
     def _create_progress_hook(self, callback):
         """
         Create a progress hook function for yt-dlp
         
+        Download updates are coalesced to one per PROGRESS_INTERVAL seconds
+        
         Args:
             callback (callable): Function to call with progress info
             
         Returns:
             callable: Progress hook function
         """
+        last_emit = float('-inf')
+        
         def hook(d):
+            nonlocal last_emit
             if callback:
                 if d['status'] == 'downloading':
+                    # yt-dlp calls this for every chunk; forward at most one
+                    # update per PROGRESS_INTERVAL ('finished'/'error' always pass)
+                    now = time.monotonic()
+                    if now - last_emit < self.PROGRESS_INTERVAL:
+                        return
+                    last_emit = now
+                    
                     # Calculate percentage
                     total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
                     downloaded = d.get('downloaded_bytes', 0)
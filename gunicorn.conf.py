@@ -0,0 +1,31 @@
+"""
+Universal Media Downloader - Gunicorn configuration
+Loaded automatically by `gunicorn app:app` (Procfile/Dockerfile)
+"""
+
+import os
+import socket
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# SSE progress streams and piped downloads hold their connection for minutes.
+# gevent workers serve each connection from a greenlet instead of an OS thread
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+# Task progress lives in process memory, keep a single worker by default
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+
+keepalive = 5
+
+# Larger send buffer so the kernel keeps sending while yt-dlp stalls.
+# Accepted client sockets inherit it from the listener (gunicorn already
+# sets TCP_NODELAY on TCP listeners)
+SEND_BUFFER_SIZE = 1 << 20
+
+
+def when_ready(server):
+    """Apply SEND_BUFFER_SIZE to the listening sockets before workers start"""
+    for listener in server.LISTENERS:
+        if listener.family in (socket.AF_INET, socket.AF_INET6):
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)